@@ -1,19 +1,26 @@
+import asyncio
 import json
 import logging
 import lzma
 import os
+import sqlite3
+import time
+from contextlib import closing
+from contextvars import ContextVar
+from functools import wraps
 from pathlib import Path
 from urllib.parse import quote_plus
 from datetime import datetime
 
 import requests
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException
 from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse, ORJSONResponse
 from fastapi_cache import FastAPICache
-from fastapi_cache.backends.inmemory import InMemoryBackend
+from fastapi_cache.backends import Backend
 from fastapi_cache.decorator import cache
+from fastapi_cache.key_builder import default_key_builder
 from sqlalchemy import create_engine, text
 
 
@@ -42,12 +49,237 @@ app.add_middleware(
 )
 app.add_middleware(GZipMiddleware, minimum_size=1000)
 
-db_engine = create_engine("sqlite:////database/birds.db")
+database_dir = Path("/database")
+db_engine = create_engine(f"sqlite:///{database_dir}/birds.db")
+
+
+# Leases taken by the current request, released by shared_cache if the
+# request never gets to set the value.
+held_leases = ContextVar("held_leases", default=None)
+
+
+class SQLiteBackend(Backend):
+    """Cache backend shared by all API worker processes through one SQLite file.
+
+    A miss in get_with_ttl also takes a lease on the key. Other requests
+    missing the same key wait for the lease holder to set the value, instead
+    of computing it again. If the holder fails, shared_cache releases the
+    lease. If the holder dies, the lease runs out and the next waiter
+    computes the value.
+    """
+
+    def __init__(
+        self,
+        path,
+        max_entries=256,
+        lease_seconds=30,
+        poll_interval=0.05,
+        touch_interval=60,
+        max_bytes=64 * 2**20,
+    ):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.touch_interval = touch_interval
+        with closing(self._connect()) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, expires REAL, accessed REAL);"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS leases (key TEXT PRIMARY KEY, expires REAL);"
+            )
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def _lookup(self, conn, key, now):
+        return conn.execute(
+            "SELECT value, expires, accessed FROM cache WHERE key = ? AND (expires IS NULL OR expires >= ?)",
+            (key, now),
+        ).fetchone()
+
+    def _get(self, key):
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            row = self._lookup(conn, key, now)
+            if not row:
+                return 0, None
+            value, expires, accessed = row
+            # Eviction only needs rough recency, so most hits stay read-only
+            # and do not queue up behind other workers for the write lock.
+            if now - accessed > self.touch_interval:
+                conn.execute("UPDATE cache SET accessed = ? WHERE key = ?", (now, key))
+        return int(expires - now) if expires else 0, value
+
+    def _take_lease(self, key):
+        now = time.time()
+        expires = now + self.lease_seconds
+        with closing(self._connect()) as conn, conn:
+            conn.execute("BEGIN IMMEDIATE")
+            # The previous holder may have set the value since our miss.
+            row = self._lookup(conn, key, now)
+            if row:
+                value, value_expires, _ = row
+                return int(value_expires - now) if value_expires else 0, value, None
+            conn.execute("DELETE FROM leases WHERE key = ? AND expires < ?", (key, now))
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO leases VALUES (?, ?)", (key, expires)
+            )
+            return 0, None, expires if cursor.rowcount == 1 else None
+
+    def _release_lease(self, key, expires):
+        # The expiry identifies our lease, in case it ran out and was taken over.
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "DELETE FROM leases WHERE key = ? AND expires = ?", (key, expires)
+            )
+
+    def _set(self, key, value, expire):
+        now = time.time()
+        expires = now + expire if expire else None
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)",
+                (key, value, expires, now),
+            )
+            conn.execute("DELETE FROM leases WHERE key = ?", (key,))
+            # Entries of old data versions are never read again, so dropping
+            # the least recently used ones is enough to get rid of them.
+            conn.execute("DELETE FROM cache WHERE expires < ?", (now,))
+            conn.execute(
+                "DELETE FROM cache WHERE key NOT IN (SELECT key FROM cache ORDER BY accessed DESC LIMIT ?)",
+                (self.max_entries,),
+            )
+            # Spectrograms are a few MB each, keep them from filling the SD card.
+            conn.execute(
+                """
+                DELETE FROM cache WHERE key IN (
+                    SELECT key FROM (
+                        SELECT key, SUM(length(CAST(value AS BLOB))) OVER (ORDER BY accessed DESC, rowid DESC) AS total
+                        FROM cache
+                    )
+                    WHERE total > ?
+                )""",
+                (self.max_bytes,),
+            )
+
+    def _reset(self):
+        with closing(self._connect()) as conn, conn:
+            conn.execute("DELETE FROM cache")
+            conn.execute("DELETE FROM leases")
+
+    def _clear(self, namespace, key):
+        with closing(self._connect()) as conn, conn:
+            if namespace:
+                cursor = conn.execute(
+                    "DELETE FROM cache WHERE key LIKE ?", (namespace + "%",)
+                )
+            else:
+                cursor = conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+            return cursor.rowcount
+
+    async def get_with_ttl(self, key):
+        while True:
+            ttl, value = await asyncio.to_thread(self._get, key)
+            if value is not None:
+                return ttl, value
+            ttl, value, lease = await asyncio.to_thread(self._take_lease, key)
+            if value is not None:
+                return ttl, value
+            if lease is not None:
+                leases = held_leases.get()
+                if leases is not None:
+                    leases[key] = lease
+                return 0, None
+            await asyncio.sleep(self.poll_interval)
+
+    async def get(self, key):
+        _, value = await asyncio.to_thread(self._get, key)
+        return value
+
+    async def set(self, key, value, expire=None):
+        await asyncio.to_thread(self._set, key, value, expire)
+        leases = held_leases.get()
+        if leases is not None:
+            leases.pop(key, None)
+
+    async def release_leases(self, leases):
+        for key, expires in leases.items():
+            await asyncio.to_thread(self._release_lease, key, expires)
+
+    async def clear(self, namespace=None, key=None):
+        return await asyncio.to_thread(self._clear, namespace, key)
+
+    async def reset(self):
+        await asyncio.to_thread(self._reset)
+
+
+def shared_cache(**kwargs):
+    """fastapi-cache's cache decorator, releasing leases of failed requests.
+
+    fastapi-cache does not clean up when the endpoint raises, which would
+    leave every later request for the key waiting for the lease to run out.
+    """
+
+    def wrapper(func):
+        cached = cache(**kwargs)(func)
+
+        @wraps(cached)
+        async def inner(*args, **kw):
+            leases = {}
+            token = held_leases.set(leases)
+            try:
+                return await cached(*args, **kw)
+            finally:
+                held_leases.reset(token)
+                if leases:
+                    await FastAPICache.get_backend().release_leases(leases)
+
+        return inner
+
+    return wrapper
+
+
+def get_data_version() -> int:
+    # Set to a new random value by the worker in the same transaction as every
+    # insert, so a replaced database does not run into versions cached before.
+    with db_engine.connect() as conn:
+        return conn.execute(text("PRAGMA user_version")).fetchone()[0]
+
+
+def versioned_key_builder(func, namespace="", **kwargs) -> str:
+    # Dashboard queries are relative to today, and otherwise only change with
+    # the data, so no expiry is needed to keep them fresh.
+    today = datetime.now().strftime("%Y-%m-%d")
+    namespace = f"{namespace}:v{get_data_version()}:{today}"
+    return default_key_builder(func, namespace, **kwargs)
+
+
+def stats_key_builder(func, namespace="", **kwargs) -> str:
+    # The last hour count also moves as time passes, without any new rows.
+    minute = datetime.now().strftime("%H:%M")
+    return versioned_key_builder(func, f"{namespace}:{minute}", **kwargs)
+
+
+def spectrogram_key_builder(func, namespace="", **kwargs) -> str:
+    # A spectrogram only depends on its own row, not on every other insert.
+    with db_engine.connect() as conn:
+        query = text("SELECT filename, scientific_name FROM birds WHERE id = :id")
+        row = conn.execute(query, {"id": kwargs["kwargs"].get("id")}).fetchone()
+    namespace = f"{namespace}:{tuple(row) if row else None}"
+    return default_key_builder(func, namespace, **kwargs)
 
 
 @app.on_event("startup")
 async def startup():
-    FastAPICache.init(InMemoryBackend())
+    backend = SQLiteBackend(str(database_dir / "api_cache.db"))
+    # The database may have been replaced while the API was down, and older
+    # databases without a random data version all start out at 0.
+    await backend.reset()
+    FastAPICache.init(backend)
 
 
 NOT_BIRDS = [
@@ -158,6 +390,7 @@ NOT_BIRDS_COMMON = [not_bird.split("_")[1] for not_bird in NOT_BIRDS]
 
 
 @app.get("/stats")
+@shared_cache(key_builder=stats_key_builder)
 async def get_stats() -> JSONResponse:
     date = datetime.now().strftime("%Y-%m-%d")
     where_date_today = (
@@ -197,6 +430,7 @@ async def get_stats() -> JSONResponse:
 
 
 @app.get("/detections")
+@shared_cache(key_builder=versioned_key_builder)
 async def get_detections(date=False) -> JSONResponse:
     if not date:
         date = datetime.now().strftime("%Y-%m-%d")
@@ -251,6 +485,7 @@ async def get_detections(date=False) -> JSONResponse:
 
 
 @app.get("/most_recent")
+@shared_cache(key_builder=versioned_key_builder)
 async def get_most_recent(n: int = 1) -> JSONResponse:
     with db_engine.connect() as conn:
         scientific_names_str = ", ".join([f'"{name}"' for name in NOT_BIRDS_SCIENTIFIC])
@@ -279,26 +514,31 @@ async def get_most_recent(n: int = 1) -> JSONResponse:
 
 
 @app.get("/spectrogram", response_class=ORJSONResponse)
-@cache(expire=15)
+@shared_cache(key_builder=spectrogram_key_builder)
 async def get_spectrogram(id: int = 1) -> JSONResponse:
     with db_engine.connect() as conn:
         query = text(f"SELECT * FROM birds WHERE id = {id}")
         row = conn.execute(query).fetchone()
+        if row is None:
+            raise HTTPException(status_code=404, detail=f"No detection with id {id}.")
         species_name = row[5].replace(" ", "_")
         file_name = row[2]
         file_name += ".json.xz"
-        file_path = Path("/database", species_name, file_name)
+        file_path = Path(database_dir, species_name, file_name)
 
         try:
             with lzma.open(file_path, "rt", encoding="UTF-8") as f:
                 data = json.load(f)
             return ORJSONResponse(data)
         except FileNotFoundError:
+            # Also the case while the worker is still moving a new recording
+            # in place, so this must not end up in the cache.
             logger.warning(f"{file_path} was not found on disk.")
+            raise HTTPException(status_code=404, detail="Spectrogram not found.")
 
 
 @app.get("/birdimage")
-@cache(expire=60 * 60 * 24)
+@shared_cache(expire=60 * 60 * 24)
 async def get_bird_image(scientific_name) -> JSONResponse:
     token = os.environ.get("FLICKR_API_TOKEN")
     URL_SEARCH = f"https://www.flickr.com/services/rest/?method=flickr.photos.search&api_key={token}&text={quote_plus(scientific_name)}&safe_search=&format=json&nojsoncallback=1&extras=url_sq"
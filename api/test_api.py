@@ -0,0 +1,148 @@
+import asyncio
+import json
+import lzma
+import sqlite3
+import tempfile
+import time
+import unittest
+from contextlib import closing
+from pathlib import Path
+from unittest import mock
+
+from fastapi.testclient import TestClient
+from fastapi_cache import FastAPICache
+from sqlalchemy import create_engine
+
+import api
+from api import SQLiteBackend, shared_cache
+
+
+class TestSQLiteBackend(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        path = str(Path(self.directory.name, "cache.db"))
+        self.backend = SQLiteBackend(path, lease_seconds=0.5, poll_interval=0.01)
+        FastAPICache.reset()
+        FastAPICache.init(self.backend)
+
+    def tearDown(self):
+        FastAPICache.reset()
+        self.directory.cleanup()
+
+    async def test_cache_hit(self):
+        await self.backend.set("key", "value", expire=60)
+        ttl, value = await self.backend.get_with_ttl("key")
+        self.assertEqual(value, "value")
+        self.assertGreater(ttl, 0)
+
+    async def test_concurrent_misses_collapse(self):
+        calls = []
+
+        @shared_cache()
+        async def compute():
+            calls.append(1)
+            await asyncio.sleep(0.1)
+            return {"result": 1}
+
+        results = await asyncio.gather(*(compute() for _ in range(5)))
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{"result": 1}] * 5)
+
+    async def test_failed_request_releases_lease(self):
+        @shared_cache()
+        async def fail():
+            raise ValueError
+
+        with self.assertRaises(ValueError):
+            await fail()
+        start = time.monotonic()
+        with self.assertRaises(ValueError):
+            await fail()
+        self.assertLess(time.monotonic() - start, self.backend.lease_seconds)
+
+    async def test_lease_expires(self):
+        # A miss takes the lease, a holder that never sets it is waited out.
+        self.assertEqual(await self.backend.get_with_ttl("key"), (0, None))
+        start = time.monotonic()
+        self.assertEqual(await self.backend.get_with_ttl("key"), (0, None))
+        self.assertGreaterEqual(time.monotonic() - start, 0.4)
+
+
+class TestEndpoints(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.database_dir = Path(self.directory.name)
+        self.db_path = self.database_dir / "birds.db"
+        with closing(sqlite3.connect(self.db_path)) as conn, conn:
+            conn.execute(
+                "CREATE TABLE birds (id INTEGER PRIMARY KEY, recording_date DATETIME, filename TEXT, confidence REAL, common_name TEXT, scientific_name TEXT);"
+            )
+        patches = [
+            mock.patch.object(api, "database_dir", self.database_dir),
+            mock.patch.object(
+                api, "db_engine", create_engine(f"sqlite:///{self.db_path}")
+            ),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.backend = SQLiteBackend(str(self.database_dir / "api_cache.db"))
+        FastAPICache.reset()
+        FastAPICache.init(self.backend)
+        # Not used as a context manager, so the startup handler does not run.
+        self.client = TestClient(api.app)
+
+    def tearDown(self):
+        FastAPICache.reset()
+        self.directory.cleanup()
+
+    def insert(self, filename, data_version=None):
+        with closing(sqlite3.connect(self.db_path)) as conn, conn:
+            conn.execute(
+                "INSERT INTO birds VALUES (?, ?, ?, ?, ?, ?)",
+                (None, 1700000000, filename, 0.9, "Amsel", "Turdus merula"),
+            )
+            if data_version is not None:
+                conn.execute(f"PRAGMA user_version = {data_version}")
+
+    def cached_keys(self):
+        with closing(sqlite3.connect(self.backend.path)) as conn:
+            return [row[0] for row in conn.execute("SELECT key FROM cache")]
+
+    def test_data_version_invalidates(self):
+        self.insert("a.mp3", data_version=1)
+        self.assertEqual(
+            self.client.get("/most_recent").json()[0]["file_name"], "a.mp3"
+        )
+
+        # Without a new data version, the cached response is still served.
+        self.insert("b.mp3")
+        self.assertEqual(
+            self.client.get("/most_recent").json()[0]["file_name"], "a.mp3"
+        )
+
+        with closing(sqlite3.connect(self.db_path)) as conn, conn:
+            conn.execute("PRAGMA user_version = 2")
+        self.assertEqual(
+            self.client.get("/most_recent").json()[0]["file_name"], "b.mp3"
+        )
+
+    def test_missing_spectrogram_is_not_cached(self):
+        self.insert("a.mp3", data_version=1)
+        self.assertEqual(self.client.get("/spectrogram?id=2").status_code, 404)
+        # The worker has inserted the row, but not moved the file in place yet.
+        self.assertEqual(self.client.get("/spectrogram?id=1").status_code, 404)
+        self.assertEqual(self.cached_keys(), [])
+
+        species_dir = self.database_dir / "Turdus_merula"
+        species_dir.mkdir()
+        with lzma.open(species_dir / "a.mp3.json.xz", "wt", encoding="UTF-8") as f:
+            json.dump([{"x": 0, "y": 0, "fill": -3.0}], f)
+        response = self.client.get("/spectrogram?id=1")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), [{"x": 0, "y": 0, "fill": -3.0}])
+        self.assertEqual(len(self.cached_keys()), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
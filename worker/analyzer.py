@@ -3,16 +3,16 @@ import json
 import logging
 import lzma
 import os
+import random
 import sqlite3
 import subprocess
 import threading
+import time
+import warnings
 from datetime import datetime
 from pathlib import Path
 
-import librosa
 import numpy as np
-import soundfile as sf
-from scipy import signal
 from birdnetlib import Recording
 from birdnetlib.analyzer import Analyzer
 from birdnetlib.watcher import DirectoryWatcher
@@ -27,8 +27,21 @@ handler.setFormatter(
 )
 logger.addHandler(handler)
 
+# Written once the model is loaded and warmed up, the recorder waits for it.
+READY_FILE = Path("/recorder/.analyzer_ready")
+# Seconds between refreshes of the ready file, see keep_ready.
+READY_INTERVAL = 5
+# BirdNET consumes 3 second chunks sampled at 48 kHz.
+SAMPLE_RATE = 48000
+WARM_UP_SAMPLES = 3 * SAMPLE_RATE
+# One of "off", "on" or "shadow", see GatedAnalyzer.
+ACTIVITY_GATE = os.environ.get("ACTIVITY_GATE", "off")
+ACTIVITY_GATE_MODES = ("off", "on", "shadow")
+
 
 def save_spectrogram_json(path):
+    import librosa
+
     y, _ = librosa.load(path)
     hop_length = 4096
 
@@ -48,6 +61,13 @@ def save_spectrogram_json(path):
     return json_path
 
 
+def bump_data_version(cursor):
+    # Tells the API that its cached responses are out of date. A random value
+    # instead of a counter, so a recreated or restored database does not reach
+    # versions the API has cached for different data.
+    cursor.execute(f"PRAGMA user_version = {random.randrange(1, 2**31)}")
+
+
 def add_detection_to_database(path, highest_confidence):
     # Connect to the database and create a cursor
     conn = sqlite3.connect("/database/birds.db")
@@ -68,6 +88,7 @@ def add_detection_to_database(path, highest_confidence):
         c.execute(
             "CREATE TABLE birds (id INTEGER PRIMARY KEY, recording_date DATETIME, filename TEXT, confidence REAL, common_name TEXT, scientific_name TEXT);"
         )
+        bump_data_version(c)
 
     if highest_confidence["is_predicted_for_location_and_date"]:
         c.execute(
@@ -81,6 +102,7 @@ def add_detection_to_database(path, highest_confidence):
                 highest_confidence["scientific_name"],
             ),
         )
+        bump_data_version(c)
     else:
         logger.info("Detection not expected for location and/or date.")
 
@@ -148,6 +170,163 @@ def on_error(recording, error):
     subprocess.run(["mv", recording.path, f"/tmp/error_recording_{file_name}"])
 
 
+def preanalyze_recording(recording):
+    import librosa
+    import soundfile as sf
+    from scipy import signal
+
+    logger.info("Low-pass filtering recording.")
+    y, sr = librosa.load(recording.path)
+    # Kept for the activity gate, which compares levels across recordings.
+    recording.peak = float(np.max(np.abs(y), initial=0.0))
+    y = librosa.util.normalize(y)
+
+    cutoff_high = 500  # Hz
+    order = 2
+
+    # Create a Filter using SciPy's Signal module
+    b1, a1 = signal.butter(order, cutoff_high / (sr / 2), "high")
+
+    # Apply the filter to the audio signal
+    y = signal.lfilter(b1, a1, y)
+    sf.write(recording.path, y, sr, format="mp3")
+
+
+def activity_features(chunks, rate=SAMPLE_RATE, band=(1000, 10000)):
+    """Band-limited energy (dB) and spectral flux for each chunk."""
+    frame_length = 1024
+    hop_length = 512
+    chunks = np.stack(chunks).astype("float32")
+    frames = np.lib.stride_tricks.sliding_window_view(chunks, frame_length, axis=-1)
+    frames = frames[:, ::hop_length] * np.hanning(frame_length)
+    freqs = np.fft.rfftfreq(frame_length, 1 / rate)
+    in_band = (freqs >= band[0]) & (freqs <= band[1])
+    magnitude = np.abs(np.fft.rfft(frames, axis=-1))[..., in_band]
+
+    power = np.sum(magnitude**2, axis=-1)
+    energy_db = 10 * np.log10(np.mean(power, axis=-1) + 1e-10)
+
+    log_magnitude = 20 * np.log10(magnitude + 1e-5)
+    rise = np.maximum(np.diff(log_magnitude, axis=1), 0)
+    flux = np.mean(rise, axis=(1, 2))
+    return energy_db, flux
+
+
+class ActivityGate:
+    """Decides which chunks are worth running through the model.
+
+    A chunk is active if its band energy or spectral flux rises clearly above
+    a noise floor. The floors follow quieter chunks immediately and louder
+    ones slowly, so steady wind or rain is absorbed into the floor over time.
+    """
+
+    def __init__(self, margin_db=6.0, flux_ratio=1.5, adapt_rate=0.05):
+        self.margin_db = margin_db
+        self.flux_ratio = flux_ratio
+        self.adapt_rate = adapt_rate
+        self.noise_floor_db = None
+        self.flux_floor = None
+        self.chunks_seen = 0
+        self.chunks_skipped = 0
+        self.detections_missed = 0
+
+    def _track(self, floor, value):
+        if floor is None or value < floor:
+            return value
+        return floor + self.adapt_rate * (value - floor)
+
+    def select(self, chunks, peak=1.0):
+        """Return which chunks are active.
+
+        `peak` is the level the recording was normalized from, so that band
+        energy stays comparable between recordings.
+        """
+        if not chunks:
+            return np.ones(0, dtype=bool)
+        energy_db, flux = activity_features(chunks)
+        energy_db += 20 * np.log10(peak + 1e-10)
+        active = np.ones(len(chunks), dtype=bool)
+        for i in range(len(chunks)):
+            if self.noise_floor_db is not None:
+                active[i] = (
+                    energy_db[i] > self.noise_floor_db + self.margin_db
+                    or flux[i] > self.flux_floor * self.flux_ratio
+                )
+            self.noise_floor_db = self._track(self.noise_floor_db, energy_db[i])
+            self.flux_floor = self._track(self.flux_floor, flux[i])
+        self.chunks_seen += len(chunks)
+        self.chunks_skipped += int(np.sum(~active))
+        return active
+
+
+class GatedAnalyzer(Analyzer):
+    """Analyzer that only runs the model on chunks the activity gate passes.
+
+    Skipped chunks get an all-zero prediction, which is below any minimum
+    confidence. In shadow mode every chunk is still analyzed, and detections
+    in chunks the gate would have skipped are counted as missed instead.
+    """
+
+    def __init__(self, *args, shadow=False, gate=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.shadow = shadow
+        self.gate = gate or ActivityGate()
+        # Which chunks of the last analyzed recording the gate passed.
+        self.last_active = np.ones(0, dtype=bool)
+        self._active_chunks = iter(())
+
+    def analyze_recording(self, recording):
+        active = self.gate.select(
+            recording.chunks, peak=getattr(recording, "peak", 1.0)
+        )
+        self.last_active = active
+        # The base class predicts the chunks in order, one call each.
+        self._active_chunks = iter(active)
+        super().analyze_recording(recording)
+
+        message = (
+            f"{int(np.sum(~active))} of {len(active)} chunks "
+            f"({self.gate.chunks_skipped} of {self.gate.chunks_seen} total)"
+        )
+        if self.shadow:
+            self.gate.detections_missed += len(self.skipped_detections(recording))
+            logger.info(
+                f"Activity gate would skip {message}, missing "
+                f"{self.gate.detections_missed} detections so far."
+            )
+        else:
+            logger.info(f"Activity gate skipped {message}.")
+
+    def skipped_detections(self, recording):
+        """Detections of the recording that lie in chunks the gate skipped."""
+        step = recording.sample_secs - recording.overlap
+        with warnings.catch_warnings():
+            # Recording.analyze only flags the recording as analyzed once
+            # analyze_recording has returned.
+            warnings.simplefilter("ignore")
+            detections = recording.detections
+        return [
+            detection
+            for detection in detections
+            # Detections not expected here are never written to the database.
+            if detection.get("is_predicted_for_location_and_date", True)
+            and not self.last_active[round(detection["start_time"] / step)]
+        ]
+
+    def _gated(self, predict, sample):
+        # Calls outside analyze_recording, like the warm-up, are never gated.
+        is_active = next(self._active_chunks, True)
+        if not is_active and not self.shadow:
+            return np.zeros((1, len(self.labels)), dtype="float32")
+        return predict(sample)
+
+    def predict(self, sample):
+        return self._gated(super().predict, sample)
+
+    def predict_with_custom_classifier(self, sample):
+        return self._gated(super().predict_with_custom_classifier, sample)
+
+
 class OutputLogger:
     def __init__(self, logger):
         self.logger = logger
@@ -175,19 +354,7 @@ class CustomDirectoryWatcher(DirectoryWatcher):
         self.is_predicted_for_location_and_date = is_predicted_for_location_and_date
 
     def recording_preanalyze(self, recording):
-        logger.info("Low-pass filtering recording.")
-        y, sr = librosa.load(recording.path)
-        y = librosa.util.normalize(y)
-
-        cutoff_high = 500  # Hz
-        order = 2
-
-        # Create a Filter using SciPy's Signal module
-        b1, a1 = signal.butter(order, cutoff_high / (sr / 2), "high")
-
-        # Apply the filter to the audio signal
-        y = signal.lfilter(b1, a1, y)
-        sf.write(recording.path, y, sr, format="mp3")
+        preanalyze_recording(recording)
 
     def _on_closed(self, event):
         # Detect for this file.
@@ -218,20 +385,78 @@ class CustomDirectoryWatcher(DirectoryWatcher):
         self.on_analyze_file_complete(recordings)
 
 
+def seconds_since_container_start():
+    # PID 1 is the first process of the container, its start time is field 22
+    # of /proc/1/stat, counted in clock ticks since boot.
+    with open("/proc/1/stat") as f:
+        start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+    with open("/proc/uptime") as f:
+        uptime = float(f.read().split()[0])
+    return uptime - start_ticks / os.sysconf("SC_CLK_TCK")
+
+
+def warm_up(analyzer):
+    # The first invoke on a fresh interpreter is much slower than the rest,
+    # so pay for it before the recorder starts producing files. Go through the
+    # same interpreter analyze_recording uses for real chunks.
+    silence = np.zeros(WARM_UP_SAMPLES, dtype="float32")
+    if analyzer.use_custom_classifier:
+        analyzer.predict_with_custom_classifier(silence)
+    else:
+        analyzer.predict(silence)
+
+
+def mark_ready(ready_file=READY_FILE):
+    ready_file.write_text(datetime.now().isoformat())
+
+
+def keep_ready(ready_file=READY_FILE):
+    # The recorder only trusts a ready file written after it started itself,
+    # so a file left over from a previous run never counts. Refreshing it lets
+    # a restarted recorder see that this analyzer is still up.
+    while True:
+        mark_ready(ready_file)
+        time.sleep(READY_INTERVAL)
+
+
+def clear_ready(ready_file=READY_FILE):
+    ready_file.unlink(missing_ok=True)
+
+
 if __name__ == "__main__":
     # Create extractions dir.
     os.makedirs("extractions", exist_ok=True)
+    # A ready file from a previous run would let the recorder start too early.
+    clear_ready()
+
+    if ACTIVITY_GATE not in ACTIVITY_GATE_MODES:
+        raise ValueError(
+            f"ACTIVITY_GATE must be one of {', '.join(ACTIVITY_GATE_MODES)}, "
+            f"not {ACTIVITY_GATE!r}."
+        )
 
     with contextlib.redirect_stdout(OutputLogger(logger=logger)):
         # Load and initialize the BirdNET-Analyzer models.
         custom_model_path = "model.tflite"
         custom_labels_path = "labels.txt"
 
-        analyzer = Analyzer(
+        analyzer_kwargs = dict(
             classifier_labels_path=custom_labels_path,
             classifier_model_path=custom_model_path,
             custom_species_list_path="/custom_species_list.txt",
         )
+        if ACTIVITY_GATE == "off":
+            analyzer = Analyzer(**analyzer_kwargs)
+        else:
+            analyzer = GatedAnalyzer(
+                shadow=ACTIVITY_GATE == "shadow", **analyzer_kwargs
+            )
+        warm_up_start = time.monotonic()
+        warm_up(analyzer)
+        logger.info(
+            f"First inference done {seconds_since_container_start():.1f}s after "
+            f"container start (warm-up took {time.monotonic() - warm_up_start:.1f}s)."
+        )
 
         directory = "/recorder"
         watcher = CustomDirectoryWatcher(
@@ -247,4 +472,5 @@ if __name__ == "__main__":
         )
         watcher.on_analyze_complete = on_analyze_complete_thread
         watcher.on_error = on_error
+        threading.Thread(target=keep_ready, daemon=True).start()
         watcher.watch()
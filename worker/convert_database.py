@@ -1,4 +1,5 @@
 import argparse
+import random
 import sqlite3
 
 
@@ -24,6 +25,9 @@ if args.old_db and args.new_db:
     new_cursor.execute(
         "CREATE TABLE birds (id INTEGER PRIMARY KEY, recording_date DATETIME, filename TEXT, confidence REAL, common_name TEXT, scientific_name TEXT);"
     )
+    # A fresh data version, so the API does not serve responses cached for
+    # another database, see bump_data_version in analyzer.py.
+    new_cursor.execute(f"PRAGMA user_version = {random.randrange(1, 2**31)}")
     # Connect to the old database
     conn = sqlite3.connect(args.old_db)
     cursor = conn.cursor()
@@ -0,0 +1,70 @@
+import argparse
+import shutil
+import tempfile
+from pathlib import Path
+
+from birdnetlib import Recording
+
+from analyzer import GatedAnalyzer, preanalyze_recording
+
+
+# Define the parser object
+parser = argparse.ArgumentParser(
+    description="Measure how many labelled detections the activity gate would miss"
+)
+parser.add_argument(
+    "--directory",
+    default="/database",
+    help="Directory of species folders, named like the ones in /database",
+)
+parser.add_argument("--min-conf", type=float, default=0.3)
+
+# Parse the arguments
+args = parser.parse_args()
+
+analyzer = GatedAnalyzer(
+    classifier_labels_path="labels.txt",
+    classifier_model_path="model.tflite",
+    custom_species_list_path="/custom_species_list.txt",
+    shadow=True,
+)
+
+# The species folder a recording sits in is its label. A label counts as
+# missed if the model finds that species only in chunks the gate skipped.
+labels_found = 0
+labels_missed = 0
+labels_not_detected = 0
+paths = sorted(Path(args.directory).glob("*/*.mp3"))
+with tempfile.TemporaryDirectory() as directory:
+    for path in paths:
+        species = path.parent.name.replace("_", " ")
+        # Preanalysis rewrites the file, so work on a copy.
+        copy_path = Path(directory, path.name)
+        shutil.copy(path, copy_path)
+        recording = Recording(analyzer, str(copy_path), min_conf=args.min_conf)
+        preanalyze_recording(recording)
+        recording.analyze()
+
+        labelled = [
+            detection
+            for detection in recording.detections
+            if detection["scientific_name"] == species
+        ]
+        skipped = [
+            detection
+            for detection in analyzer.skipped_detections(recording)
+            if detection["scientific_name"] == species
+        ]
+        if not labelled:
+            labels_not_detected += 1
+        elif len(skipped) == len(labelled):
+            labels_missed += 1
+        else:
+            labels_found += 1
+
+gate = analyzer.gate
+print(f"Recordings: {len(paths)}")
+print(f"Chunks: {gate.chunks_seen}, skipped: {gate.chunks_skipped}")
+print(f"Labelled species kept: {labels_found}, missed: {labels_missed}")
+print(f"Labelled species not detected even without the gate: {labels_not_detected}")
+print(f"All detections missed: {gate.detections_missed}")
@@ -3,7 +3,9 @@ import os
 import subprocess
 import sys
 import threading
+import time
 from datetime import datetime
+from pathlib import Path
 from time import sleep
 
 
@@ -18,6 +20,9 @@ logger.addHandler(handler)
 
 
 RECORDING_LENGTH = 15
+# Written by the analyzer once its model is loaded and warmed up, and
+# refreshed every few seconds while it is running.
+READY_FILE = Path("/recorder/.analyzer_ready")
 
 
 def log_subprocess_output(pipe):
@@ -45,15 +50,29 @@ def run_recording():
     sys.exit(exitcode)
 
 
-# Sleep initially to wait for the analyzer to come up.
-sleep(30)
+def is_analyzer_ready(since, ready_file=READY_FILE):
+    # A file from before `since` may be left over from a previous run, while
+    # the new analyzer is still loading.
+    try:
+        return ready_file.stat().st_mtime > since
+    except FileNotFoundError:
+        return False
 
-# Main loop, where recording is done.
-while True:
-    logger.info("Starting thread.")
-    thread = threading.Thread(target=run_recording)
-    thread.start()
-    logger.info("Sleeping...")
 
-    # Sleep one second longer than recording to ensure the audio device is free.
-    sleep(RECORDING_LENGTH + 1)
+if __name__ == "__main__":
+    # Wait for the analyzer to come up, instead of guessing how long it takes.
+    logger.info("Waiting for analyzer.")
+    start_time = time.time()
+    while not is_analyzer_ready(start_time):
+        sleep(1)
+    logger.info("Analyzer is ready.")
+
+    # Main loop, where recording is done.
+    while True:
+        logger.info("Starting thread.")
+        thread = threading.Thread(target=run_recording)
+        thread.start()
+        logger.info("Sleeping...")
+
+        # Sleep one second longer than recording to ensure the audio device is free.
+        sleep(RECORDING_LENGTH + 1)
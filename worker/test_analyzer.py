@@ -1,7 +1,21 @@
+import tempfile
 import unittest
 from pathlib import Path
+from unittest import mock
 
-from analyzer import save_spectrogram_json
+import numpy as np
+from birdnetlib.analyzer import Analyzer
+from birdnetlib.main import RecordingBuffer
+
+from analyzer import (
+    ActivityGate,
+    GatedAnalyzer,
+    clear_ready,
+    mark_ready,
+    save_spectrogram_json,
+)
+
+LABELS = ["Turdus merula_Amsel", "Homo sapiens_Human vocal"]
 
 
 class dotdict(dict):
@@ -16,12 +30,112 @@ class dotdict(dict):
             self[key] = value
 
 
+class StubInterpreter:
+    """Stands in for the TFLite interpreter, always predicting the first label."""
+
+    def __init__(self):
+        self.invocations = 0
+
+    def resize_tensor_input(self, index, shape):
+        pass
+
+    def allocate_tensors(self):
+        pass
+
+    def set_tensor(self, index, data):
+        pass
+
+    def invoke(self):
+        self.invocations += 1
+
+    def get_tensor(self, index):
+        logits = np.full((1, len(LABELS)), -15.0)
+        logits[0, 0] = 15.0
+        return logits
+
+
+def stub_analyzer_init(self, *args, **kwargs):
+    self.labels = LABELS
+    self.use_custom_classifier = False
+    self.classifier_model_path = None
+    self.has_custom_species_list = False
+    self.custom_species_list = []
+    self.input_layer_index = 0
+    self.output_layer_index = 0
+    self.interpreter = StubInterpreter()
+
+
 class TestAnalyzer(unittest.TestCase):
     def test_save_spectrogram_json(self):
         recording = dotdict({"path": "./test.mp3"})
         json_path = save_spectrogram_json(recording)
         self.assertEqual(json_path, Path("/recorder/test.mp3.json.xz"))
 
+    def test_ready_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            ready_file = Path(directory, ".analyzer_ready")
+            clear_ready(ready_file)
+            self.assertFalse(ready_file.exists())
+            mark_ready(ready_file)
+            self.assertTrue(ready_file.exists())
+            clear_ready(ready_file)
+            self.assertFalse(ready_file.exists())
+
+    def test_activity_gate(self):
+        rng = np.random.default_rng(0)
+        t = np.arange(3 * 48000) / 48000
+        noise = [0.01 * rng.standard_normal(len(t)) for _ in range(4)]
+        call = noise[0] + 0.1 * np.sin(2 * np.pi * 4000 * t)
+
+        gate = ActivityGate()
+        gate.select(noise)
+        active = gate.select([noise[1], call, noise[2]])
+        self.assertEqual(list(active), [False, True, False])
+        self.assertEqual(gate.chunks_seen, 7)
+        self.assertEqual(gate.chunks_skipped, 5)
+
+    def test_activity_gate_normalized_recording(self):
+        rng = np.random.default_rng(0)
+        noise = [0.01 * rng.standard_normal(3 * 48000) for _ in range(6)]
+
+        gate = ActivityGate()
+        gate.select(noise[:3])
+        # The same noise level, normalized up by a factor of 10.
+        active = gate.select([chunk * 10 for chunk in noise[3:]], peak=0.1)
+        self.assertFalse(active.any())
+        self.assertEqual(len(gate.select([])), 0)
+
+    def analyze_gated(self, shadow):
+        rng = np.random.default_rng(0)
+        t = np.arange(3 * 48000) / 48000
+        noise = [0.01 * rng.standard_normal(len(t)) for _ in range(8)]
+        noise[5] += 0.1 * np.sin(2 * np.pi * 4000 * t)
+
+        with mock.patch.object(Analyzer, "__init__", stub_analyzer_init):
+            analyzer = GatedAnalyzer(shadow=shadow)
+        analyzer.gate.select(noise[:3])
+        recording = RecordingBuffer(
+            analyzer, np.concatenate(noise[3:]), 48000, min_conf=0.3
+        )
+        recording.analyze()
+        return analyzer, recording
+
+    def test_gated_analyzer(self):
+        analyzer, recording = self.analyze_gated(shadow=False)
+        # Only the chunk with the tone reaches the model.
+        self.assertEqual(analyzer.interpreter.invocations, 1)
+        self.assertEqual(list(analyzer.last_active), [False, False, True, False, False])
+        start_times = [d["start_time"] for d in recording.detections]
+        self.assertEqual(start_times, [6.0])
+        self.assertEqual(analyzer.gate.detections_missed, 0)
+
+    def test_gated_analyzer_shadow(self):
+        analyzer, recording = self.analyze_gated(shadow=True)
+        self.assertEqual(analyzer.interpreter.invocations, 5)
+        start_times = [d["start_time"] for d in recording.detections]
+        self.assertEqual(start_times, [0.0, 3.0, 6.0, 9.0, 12.0])
+        self.assertEqual(analyzer.gate.detections_missed, 4)
+
 
 if __name__ == "__main__":
     unittest.main()
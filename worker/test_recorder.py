@@ -0,0 +1,27 @@
+import os
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+from recorder import is_analyzer_ready
+
+
+class TestRecorder(unittest.TestCase):
+    def test_is_analyzer_ready(self):
+        with tempfile.TemporaryDirectory() as directory:
+            ready_file = Path(directory, ".analyzer_ready")
+            start_time = time.time()
+            self.assertFalse(is_analyzer_ready(start_time, ready_file))
+
+            # Left over from a run before the recorder started.
+            ready_file.write_text("")
+            os.utime(ready_file, (start_time - 60, start_time - 60))
+            self.assertFalse(is_analyzer_ready(start_time, ready_file))
+
+            os.utime(ready_file, (start_time + 1, start_time + 1))
+            self.assertTrue(is_analyzer_ready(start_time, ready_file))
+
+
+if __name__ == "__main__":
+    unittest.main()